@@ -0,0 +1,121 @@
+# Copyright 2025 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Workload helpers shared by the autopkgtest charms.
+
+charmcraft only packs the charm's own directory, so every charm ships an
+identical copy of this file in its src directory. Change all of them
+together; pre-commit checks that they match.
+"""
+
+import logging
+import os
+import time
+from pathlib import Path
+
+from charmlibs import apt, systemd
+
+logger = logging.getLogger(__name__)
+
+PROXY_ENV_PATH = Path("/etc/environment.d/proxy.conf")
+PROXY_ENV_TEMPLATE = "http_proxy={http}\nhttps_proxy={https}\nno_proxy={no}\n"
+
+APT_SOURCES = (Path("/etc/apt/sources.list"), Path("/etc/apt/sources.list.d"))
+# Touched after every package index refresh done by the charms
+APT_UPDATE_STAMP = Path("/var/lib/apt/periodic/autopkgtest-charm-update-stamp")
+# The package index is not refreshed again if updated more recently than this
+APT_UPDATE_MAX_AGE = 60 * 60
+
+
+def update_file(path: Path, content: str) -> bool:
+    """Write content to path unless it is already there.
+
+    Return whether the file changed.
+    """
+    try:
+        if path.read_text() == content:
+            return False
+    except FileNotFoundError:
+        pass
+    path.write_text(content)
+    return True
+
+
+def write_proxy_env():
+    """Pass the Juju proxy settings on to the system environment."""
+    env = os.environ
+    PROXY_ENV_PATH.parent.mkdir(exist_ok=True)
+    PROXY_ENV_PATH.write_text(
+        PROXY_ENV_TEMPLATE.format(
+            http=env.get("JUJU_CHARM_HTTP_PROXY", ""),
+            https=env.get("JUJU_CHARM_HTTPS_PROXY", ""),
+            no=env.get("JUJU_CHARM_NO_PROXY", ""),
+        )
+    )
+
+
+def install_units(src_dir: Path, dest_dir: Path, env, context: dict) -> list[str]:
+    """Install the systemd units in src_dir into dest_dir.
+
+    Units named *.j2 are rendered from the jinja2 env with context. systemd
+    is reloaded if any unit changed. Return the names of the installed units.
+    """
+    installed = []
+    changed = False
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".j2"):
+                unit = entry.name.removesuffix(".j2")
+                content = env.get_template(entry.name).render(context)
+            else:
+                unit = entry.name
+                content = Path(entry.path).read_text()
+            # only rewrite units that differ from what is already installed
+            if update_file(dest_dir / unit, content):
+                changed = True
+            installed.append(unit)
+
+    if changed:
+        systemd.daemon_reload()
+    return installed
+
+
+def _mtime(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def update_package_index():
+    """Refresh the apt package index.
+
+    The refresh is skipped if the last one is recent and no apt source was
+    added, removed or edited since.
+    """
+    last_update = _mtime(APT_UPDATE_STAMP)
+    sources = [*APT_SOURCES, *APT_SOURCES[1].glob("*")]
+    if (
+        time.time() - last_update < APT_UPDATE_MAX_AGE
+        and max(map(_mtime, sources)) <= last_update
+    ):
+        logger.info("package index is recent, not updating it")
+        return
+
+    logger.info("updating package index")
+    apt.update()
+    APT_UPDATE_STAMP.parent.mkdir(parents=True, exist_ok=True)
+    APT_UPDATE_STAMP.touch()
+
+
+def install_snaps(dependencies: list[dict[str, str]]):
+    """Install the snaps in dependencies not already on the right channel."""
+    # not every charm installs snaps or ships the snap library
+    from charmlibs import snap
+
+    installed = snap.SnapCache()
+    for dep in dependencies:
+        current = installed[dep["name"]]
+        if current.present and current.channel == dep["channel"]:
+            continue
+        snap.add(dep["name"], channel=dep["channel"])
@@ -10,7 +10,13 @@ from pathlib import Path
 from textwrap import dedent
 
 import jinja2
-from charmlibs import apt, snap, systemd
+from autopkgtest_common import (
+    install_snaps,
+    install_units,
+    update_package_index,
+    write_proxy_env,
+)
+from charmlibs import apt, systemd
 from systemd_helper import SystemdHelper
 
 logger = logging.getLogger(__name__)
@@ -49,6 +55,11 @@ SWIFT_CONFIG_PATH = CONF_DIRECTORY / "swift.cred"
 # charm files path
 CHARM_SOURCE_PATH = Path(__file__).parent.parent
 CHARM_APP_DATA = CHARM_SOURCE_PATH / "app"
+UNITS_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(CHARM_APP_DATA / "units"),
+    autoescape=jinja2.select_autoescape(),
+    auto_reload=False,
+)
 
 WORKER_TOOLS_DEST = Path("/usr/local/bin/")
 
@@ -136,17 +147,7 @@ def install(autopkgtest_branch, releases):
     """Install dispatcher."""
     if is_proxy_defined():
         logger.info("installing proxy environment file")
-        Path("/etc/environment.d").mkdir(exist_ok=True)
-        with open("/etc/environment.d/proxy.conf", "w") as file:
-            file.write(
-                dedent(
-                    f"""\
-                    http_proxy={os.getenv("JUJU_CHARM_HTTP_PROXY", "")}
-                    https_proxy={os.getenv("JUJU_CHARM_HTTPS_PROXY", "")}
-                    no_proxy={os.getenv("JUJU_CHARM_NO_PROXY", "")}
-                    """
-                )
-            )
+        write_proxy_env()
 
     logger.info(f"configuring unprivileged user {USER!r}")
 
@@ -157,13 +158,11 @@ def install(autopkgtest_branch, releases):
         check=True,
     )
 
-    logger.info("updating package index")
-    apt.update()
+    update_package_index()
 
     logger.info("installing packages")
     apt.add_package(DEB_DEPENDENCIES)
-    for needed_snap in SNAP_DEPENDENCIES:
-        snap.add(needed_snap["name"], channel=needed_snap["channel"])
+    install_snaps(SNAP_DEPENDENCIES)
 
     # Remove fwupd and reset state of its refresh service, so it won't
     # make the system degraded.
@@ -204,31 +203,16 @@ def install(autopkgtest_branch, releases):
     write_worker_config(releases)
 
     logger.info("installing systemd units")
-    units_path = CHARM_APP_DATA / "units"
-    units_to_install = [u.name for u in (units_path).glob("*")]
-    units_to_enable = [u.name for u in (units_path).glob("*.timer")]
-
-    system_units_dir = Path("/etc/systemd/system/")
-    j2env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(units_path),
-        autoescape=jinja2.select_autoescape(),
-    )
     j2context = {
         "user": USER,
         "conf_directory": CONF_DIRECTORY,
         "rabbitmq_creds_path": RABBITMQ_CREDS_PATH,
         "autopkgtest_package_configs_location": AUTOPKGTEST_PACKAGE_CONFIGS_LOCATION,
     }
-    for unit in units_to_install:
-        if unit.endswith(".j2"):
-            unit_basename = unit.removesuffix(".j2")
-            j2template = j2env.get_template(unit)
-            with open(system_units_dir / unit_basename, "w") as f:
-                f.write(j2template.render(j2context))
-        else:
-            shutil.copy(units_path / unit, system_units_dir)
-
-    systemd.daemon_reload()
+    installed = install_units(
+        CHARM_APP_DATA / "units", Path("/etc/systemd/system/"), UNITS_ENV, j2context
+    )
+    units_to_enable = [u for u in installed if u.endswith(".timer")]
     if units_to_enable:
         systemd.service_enable("--now", *units_to_enable)
 
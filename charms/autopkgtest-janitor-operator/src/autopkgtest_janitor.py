@@ -16,12 +16,23 @@ from pathlib import Path
 from textwrap import dedent
 
 import jinja2
-from charmlibs import apt, snap, systemd
+from autopkgtest_common import (
+    install_snaps,
+    install_units,
+    update_package_index,
+    write_proxy_env,
+)
+from charmlibs import apt, systemd
 
 logger = logging.getLogger(__name__)
 
 CHARM_SOURCE_PATH = Path(__file__).parent.parent
 CHARM_APP_DATA = CHARM_SOURCE_PATH / "app"
+UNITS_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(CHARM_APP_DATA / "units"),
+    autoescape=jinja2.select_autoescape(),
+    auto_reload=False,
+)
 USER = "ubuntu"
 CHARM_TOOLS_DEST = Path("/usr/local/bin")
 
@@ -30,27 +41,30 @@ RABBITMQ_CREDS_PATH = CONF_DIRECTORY / "rabbitmq.cred"
 TARGETS_PATH = CONF_DIRECTORY / "targets.conf"
 
 AUTOPKGTEST_REPO = "https://salsa.debian.org/ubuntu-ci-team/autopkgtest.git"
-AUTOPKGTEST_LOCATION = Path(f"~{USER}/autopkgtest").expanduser()
+USER_HOME = Path(f"~{USER}").expanduser()
+AUTOPKGTEST_LOCATION = USER_HOME / "autopkgtest"
 
 # Releases not listed here are assumed to support any architecture.
 # For ESM supported architectures see https://ubuntu.com/security/esm.
 RELEASE_ARCH_RESTRICTIONS = {
-    "trusty": ["amd64"],
-    "xenial": ["amd64", "s390x"],
-    "bionic": ["amd64", "arm64", "ppc64el", "s390x"],
-    "focal": ["amd64", "arm64", "armhf", "ppc64el", "s390x"],
-    "jammy": ["amd64", "arm64", "armhf", "ppc64el", "riscv64", "s390x"],
-    "noble": ["amd64", "arm64", "armhf", "ppc64el", "riscv64", "s390x"],
-    "oracular": ["amd64", "arm64", "armhf", "ppc64el", "riscv64", "s390x"],
-    "questing": ["amd64", "arm64", "armhf", "ppc64el", "riscv64", "s390x"],
+    "trusty": frozenset({"amd64"}),
+    "xenial": frozenset({"amd64", "s390x"}),
+    "bionic": frozenset({"amd64", "arm64", "ppc64el", "s390x"}),
+    "focal": frozenset({"amd64", "arm64", "armhf", "ppc64el", "s390x"}),
+    "jammy": frozenset({"amd64", "arm64", "armhf", "ppc64el", "riscv64", "s390x"}),
+    "noble": frozenset({"amd64", "arm64", "armhf", "ppc64el", "riscv64", "s390x"}),
+    "oracular": frozenset({"amd64", "arm64", "armhf", "ppc64el", "riscv64", "s390x"}),
+    "questing": frozenset({"amd64", "arm64", "armhf", "ppc64el", "riscv64", "s390x"}),
 }
 
-NO_CONTAINER_RELEASES = [
-    "xenial",
-]
+NO_CONTAINER_RELEASES = frozenset(
+    {
+        "xenial",
+    }
+)
 
 # List of architecture for which the charm should create VM images.
-VM_ARCHITECTURES = ["amd64", "amd64v3", "s390x"]
+VM_ARCHITECTURES = frozenset({"amd64", "amd64v3", "s390x"})
 
 DEB_DEPENDENCIES = [
     "python3-pika",
@@ -72,16 +86,23 @@ def get_remote_arch_index(remote):
     return arch, index
 
 
-def run_as_user(command: str, *, capture_output=False, check=True):
+def run_as_user(*command: str | Path, capture_output=False, check=True):
+    """Run command as USER, without going through a shell."""
+    # the environment a login shell for USER would have, plus the proxy
+    # settings the charm runs with
+    env = {
+        "HOME": str(USER_HOME),
+        "USER": USER,
+        "LOGNAME": USER,
+        "PATH": "/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:/snap/bin",
+    }
+    for var in ("https_proxy", "http_proxy", "no_proxy"):
+        if var in os.environ:
+            env[var] = os.environ[var]
     return subprocess.run(
-        [
-            "su",
-            "--login",
-            "--whitelist-environment=https_proxy,http_proxy,no_proxy",
-            USER,
-            "--command",
-            command,
-        ],
+        ["runuser", "--user", USER, "--", *command],
+        env=env,
+        cwd=USER_HOME,
         capture_output=capture_output,
         check=check,
         text=True,
@@ -95,45 +116,49 @@ def disable_image_builders(remote, releases):
     # and stop/disable all of them.
 
     arch, index = get_remote_arch_index(remote)
-    for release in releases:
-        # stop all matching units
-        systemd.service_stop(f"autopkgtest-build-image@{arch}-{index}-{release}-*.*")
-
-        # disable all enabled matching units
-
-        # note: list-units-files returns 1 is no units are matched,
-        # hence the check=False.
-        out = subprocess.run(
-            [
-                "systemctl",
-                "list-unit-files",
-                "--no-legend",
-                "--no-pager",
-                "--state=enabled",
-                f"autopkgtest-build-image@{arch}-{index}-{release}-*.*",
-            ],
-            text=True,
-            capture_output=True,
-            check=False,
-        ).stdout
-        if out:
-            services = [line.split()[0] for line in out.splitlines()]
-            systemd.service_disable(*services)
-
-        # reset failed state
-        subprocess.run(
-            [
-                "systemctl",
-                "reset-failed",
-                f"autopkgtest-build-image@{arch}-{index}-{release}-*.*",
-            ],
-            stderr=subprocess.DEVNULL,
-        )
+    prefix = f"autopkgtest-build-image@{arch}-{index}-"
+    patterns = [prefix + release + "-*.*" for release in releases]
+    if not patterns:
+        return
+
+    # stop all matching units
+    systemd.service_stop(*patterns)
+
+    # disable all enabled matching units
+
+    # note: list-units-files returns 1 is no units are matched,
+    # hence the check=False.
+    out = subprocess.run(
+        [
+            "systemctl",
+            "list-unit-files",
+            "--no-legend",
+            "--no-pager",
+            "--state=enabled",
+            *patterns,
+        ],
+        text=True,
+        capture_output=True,
+        check=False,
+    ).stdout
+    if out:
+        services = [line.split()[0] for line in out.splitlines()]
+        systemd.service_disable(*services)
+
+    # reset failed state
+    subprocess.run(
+        ["systemctl", "reset-failed", *patterns],
+        stderr=subprocess.DEVNULL,
+    )
 
 
 def enable_image_builders(remote, releases):
-    for i, release in enumerate(releases):
-        arch, index = get_remote_arch_index(remote)
+    arch, index = get_remote_arch_index(remote)
+    prefix = f"autopkgtest-build-image@{arch}-{index}-"
+    build_vms = arch in VM_ARCHITECTURES
+    timers = []
+    services = []
+    for release in releases:
         if (
             release in RELEASE_ARCH_RESTRICTIONS
             and arch not in RELEASE_ARCH_RESTRICTIONS[release]
@@ -141,36 +166,30 @@ def enable_image_builders(remote, releases):
             logger.info(f"Not creating images for {release}/{arch}")
             continue
 
-        timers = []
-        services = []
         if release not in NO_CONTAINER_RELEASES:
-            timers.append(
-                f"autopkgtest-build-image@{arch}-{index}-{release}-container.timer"
-            )
-            services.append(
-                f"autopkgtest-build-image@{arch}-{index}-{release}-container.service"
-            )
-        if arch in VM_ARCHITECTURES:
-            timers.append(f"autopkgtest-build-image@{arch}-{index}-{release}-vm.timer")
-            services.append(
-                f"autopkgtest-build-image@{arch}-{index}-{release}-vm.service"
-            )
+            unit = prefix + release + "-container"
+            timers.append(unit + ".timer")
+            services.append(unit + ".service")
+        if build_vms:
+            unit = prefix + release + "-vm"
+            timers.append(unit + ".timer")
+            services.append(unit + ".service")
 
-        if not timers:
-            continue
+    if not timers:
+        return
 
-        logger.info(f"Enabling periodic image builds for {release} on remote {remote}")
-        systemd.service_enable("--now", *timers)
+    logger.info(f"Enabling periodic image builds on remote {remote}")
+    systemd.service_enable("--now", *timers)
 
-        logger.info(f"Starting image builds for {release} on remote {remote}")
-        systemd.service_start("--no-block", *services)
+    logger.info(f"Starting image builds on remote {remote}")
+    systemd.service_start("--no-block", *services)
 
 
 def configure_unprivileged_user():
     logger.info(f"configuring unprivileged user {USER!r}")
 
     # enable-linger so that systemd does not clean the user session
-    # after the last logout of USER, e.g. at the end of a `su` session.
+    # after the last logout of USER, e.g. after a `runuser` command.
     subprocess.run(
         ["loginctl", "enable-linger", USER],
         check=True,
@@ -179,7 +198,7 @@ def configure_unprivileged_user():
 
 def update_distro_info_data():
     logger.info("updating distro-info-data")
-    apt.update()
+    update_package_index()
     # Note apt.add_package() does not upgrade an already installed package.
     subprocess.run(
         [
@@ -194,9 +213,16 @@ def update_distro_info_data():
 
 def update_autopkgtest(autopkgtest_branch):
     logger.info("updating autopkgtest")
-    run_as_user(f"git -C '{AUTOPKGTEST_LOCATION}' fetch origin '{autopkgtest_branch}'")
     run_as_user(
-        f"git -C {AUTOPKGTEST_LOCATION} reset --hard origin/{autopkgtest_branch}"
+        "git", "-C", AUTOPKGTEST_LOCATION, "fetch", "origin", autopkgtest_branch
+    )
+    run_as_user(
+        "git",
+        "-C",
+        AUTOPKGTEST_LOCATION,
+        "reset",
+        "--hard",
+        f"origin/{autopkgtest_branch}",
     )
 
 
@@ -233,32 +259,17 @@ def write_rabbitmq_creds(hostname, username, password):
 
 def install_systemd_units(mirror):
     logger.info("installing systemd units")
-    units_path = CHARM_APP_DATA / "units"
-    units_to_install = [u.name for u in units_path.glob("*")]
-    # enable all non-template timers
-    units_to_enable = [u.name for u in units_path.glob("*.timer") if "@" not in u.name]
-
-    system_units_dir = Path("/etc/systemd/system/")
-    j2env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(units_path),
-        autoescape=jinja2.select_autoescape(),
-    )
     j2context = {
         "user": USER,
         "autopkgtest_location": AUTOPKGTEST_LOCATION,
         "config": CONF_DIRECTORY,
         "mirror": mirror,
     }
-    for unit in units_to_install:
-        if unit.endswith(".j2"):
-            unit_basename = unit.removesuffix(".j2")
-            j2template = j2env.get_template(unit)
-            with open(system_units_dir / unit_basename, "w") as f:
-                f.write(j2template.render(j2context))
-        else:
-            shutil.copy(units_path / unit, system_units_dir)
-
-    systemd.daemon_reload()
+    installed = install_units(
+        CHARM_APP_DATA / "units", Path("/etc/systemd/system/"), UNITS_ENV, j2context
+    )
+    # enable all non-template timers
+    units_to_enable = [u for u in installed if u.endswith(".timer") and "@" not in u]
     if units_to_enable:
         systemd.service_enable("--now", *units_to_enable)
 
@@ -267,15 +278,18 @@ def configure_builder_units(remotes, stored_releases, target_releases):
     logger.info("enabling/disabling builder units")
     logger.info(f"target releases: {' '.join(target_releases)}")
 
-    old_releases = [r for r in stored_releases if r not in target_releases]
+    stored = frozenset(stored_releases)
+    target = frozenset(target_releases)
+
+    old_releases = stored - target
     if old_releases:
-        logger.info(f"releases to sunset: {' '.join(old_releases)}")
+        logger.info(f"releases to sunset: {' '.join(sorted(old_releases))}")
         for remote in remotes:
             disable_image_builders(remote, old_releases)
 
-    new_releases = [r for r in target_releases if r not in stored_releases]
+    new_releases = target - stored
     if new_releases:
-        logger.info(f"new releases to activate {' '.join(new_releases)}")
+        logger.info(f"new releases to activate {' '.join(sorted(new_releases))}")
         for remote in remotes:
             enable_image_builders(remote, new_releases)
 
@@ -284,20 +298,9 @@ def install(autopkgtest_branch):
     """Install janitor."""
     if "JUJU_CHARM_HTTPS_PROXY" in os.environ or "JUJU_CHARM_HTTP_PROXY" in os.environ:
         logger.info("Installing proxy environment file")
-        Path("/etc/environment.d").mkdir(exist_ok=True)
-        with open("/etc/environment.d/proxy.conf", "w") as file:
-            file.write(
-                dedent(
-                    f"""\
-                    http_proxy={os.getenv("JUJU_CHARM_HTTP_PROXY", "")}
-                    https_proxy={os.getenv("JUJU_CHARM_HTTPS_PROXY", "")}
-                    no_proxy={os.getenv("JUJU_CHARM_NO_PROXY", "")}
-                    """
-                )
-            )
+        write_proxy_env()
 
-    logger.info("updating package index")
-    apt.update()
+    update_package_index()
 
     logger.info("installing packages")
     apt.add_package(DEB_DEPENDENCIES)
@@ -312,8 +315,7 @@ def install(autopkgtest_branch):
     )
 
     logger.info("installing snaps")
-    for dep in SNAP_DEPENDENCIES:
-        snap.add(dep["name"], channel=dep["channel"])
+    install_snaps(SNAP_DEPENDENCIES)
 
     logger.info("creating directories")
     CONF_DIRECTORY.mkdir(exist_ok=True)
@@ -327,7 +329,12 @@ def install(autopkgtest_branch):
     logger.info("cloning autopkgtest repository")
     shutil.rmtree(AUTOPKGTEST_LOCATION, ignore_errors=True)
     run_as_user(
-        f"git clone --branch '{autopkgtest_branch}' '{AUTOPKGTEST_REPO}' '{AUTOPKGTEST_LOCATION}'"
+        "git",
+        "clone",
+        "--branch",
+        autopkgtest_branch,
+        AUTOPKGTEST_REPO,
+        AUTOPKGTEST_LOCATION,
     )
 
 
@@ -356,13 +363,15 @@ def configure(
 
 def get_remotes():
     return json.loads(
-        run_as_user("lxc remote list --format=json", capture_output=True).stdout
+        run_as_user(
+            "lxc", "remote", "list", "--format=json", capture_output=True
+        ).stdout
     )
 
 
 def add_remote(remote: str, token: str, all_releases: list[str]):
     """Handle adding a new remote."""
-    run_as_user(f"lxc remote add '{remote}' '{token}'")
+    run_as_user("lxc", "remote", "add", remote, token)
 
     if remote not in get_remotes():
         raise Exception(f"LXD not reporting remote {remote} as expected")
@@ -373,7 +382,7 @@ def add_remote(remote: str, token: str, all_releases: list[str]):
 def remove_remote(remote: str, all_releases):
     """Remove an existing remote."""
     disable_image_builders(remote, all_releases)
-    run_as_user(f"lxc remote remove '{remote}'", check=False)
+    run_as_user("lxc", "remote", "remove", remote, check=False)
 
     if remote in get_remotes():
         raise Exception(f"LXD still reporting remote {remote} after removal")
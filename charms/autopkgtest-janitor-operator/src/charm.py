@@ -18,6 +18,24 @@ class AutopkgtestJanitorCharm(ops.CharmBase):
 
     _stored = StoredState()
 
+    # (event, handler) pairs observed on every dispatch
+    _OBSERVERS = (
+        # basic hooks
+        ("install", "_on_install"),
+        ("config_changed", "_on_config_changed"),
+        ("start", "_on_start"),
+        ("upgrade_charm", "_on_install"),
+        ("update_status", "_on_update_status"),
+        # action hooks
+        ("add_remote_action", "_on_add_remote"),
+        ("remove_remote_action", "_on_remove_remote"),
+        ("rebuild_all_images_action", "_on_rebuild_all_images"),
+        # relation hooks
+        ("amqp_relation_joined", "_on_amqp_relation_joined"),
+        ("amqp_relation_changed", "_on_amqp_relation_changed"),
+        ("amqp_relation_broken", "_on_amqp_relation_broken"),
+    )
+
     def __init__(self, framework: ops.Framework):
         super().__init__(framework)
 
@@ -33,24 +51,8 @@ class AutopkgtestJanitorCharm(ops.CharmBase):
             amqp_password=None,
         )
 
-        # basic hooks
-        framework.observe(self.on.install, self._on_install)
-        framework.observe(self.on.config_changed, self._on_config_changed)
-        framework.observe(self.on.start, self._on_start)
-        framework.observe(self.on.upgrade_charm, self._on_install)
-        framework.observe(self.on.update_status, self._on_update_status)
-
-        # action hooks
-        framework.observe(self.on.add_remote_action, self._on_add_remote)
-        framework.observe(self.on.remove_remote_action, self._on_remove_remote)
-        framework.observe(
-            self.on.rebuild_all_images_action, self._on_rebuild_all_images
-        )
-
-        # relation hooks
-        framework.observe(self.on.amqp_relation_joined, self._on_amqp_relation_joined)
-        framework.observe(self.on.amqp_relation_changed, self._on_amqp_relation_changed)
-        framework.observe(self.on.amqp_relation_broken, self._on_amqp_relation_broken)
+        for event, handler in self._OBSERVERS:
+            framework.observe(getattr(self.on, event), getattr(self, handler))
 
     def _on_install(self, event: ops.InstallEvent):
         self.unit.status = ops.MaintenanceStatus("installing janitor charm")
@@ -58,15 +60,21 @@ class AutopkgtestJanitorCharm(ops.CharmBase):
 
     def _on_start(self, event: ops.StartEvent):
         """Handle start event."""
+        self._start()
+
+    def _start(self):
         if isinstance(self.unit.status, ops.BlockedStatus):
             return
 
         autopkgtest_janitor.start()
         self.unit.status = ops.ActiveStatus()
-        self.on.update_status.emit()
+        self._update_status()
 
     def _on_update_status(self, event: ops.UpdateStatusEvent):
         """Handle update-status event."""
+        self._update_status()
+
+    def _update_status(self):
         if not isinstance(self.unit.status, ops.ActiveStatus):
             return
 
@@ -120,6 +128,9 @@ class AutopkgtestJanitorCharm(ops.CharmBase):
     # config helpers
 
     def _on_config_changed(self, event: ops.ConfigChangedEvent):
+        self._configure()
+
+    def _configure(self):
         if not self._stored.got_amqp_creds:
             self.unit.status = ops.BlockedStatus("waiting for AMQP relation")
             return
@@ -135,7 +146,7 @@ class AutopkgtestJanitorCharm(ops.CharmBase):
             amqp_password=self._stored.amqp_password,
         )
         self._stored.releases = self.typed_config.releases
-        self.on.start.emit()
+        self._start()
 
     # relation hooks
 
@@ -165,14 +176,14 @@ class AutopkgtestJanitorCharm(ops.CharmBase):
         self._stored.amqp_hostname = hostname
         self._stored.amqp_password = password
 
-        self.on.config_changed.emit()
+        self._configure()
 
     def _on_amqp_relation_broken(self, event: ops.RelationBrokenEvent):
         self._stored.got_amqp_creds = False
         self._stored.amqp_hostname = None
         self._stored.amqp_password = None
 
-        self.on.config_changed.emit()
+        self._configure()
 
 
 if __name__ == "__main__":  # pragma: nocover
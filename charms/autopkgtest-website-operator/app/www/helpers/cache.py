@@ -1,59 +1,30 @@
-import fcntl
 import json
-from pathlib import Path
+import sqlite3
 
 
 class KeyValueCache:
     def __init__(self, cache_path):
-        self.path = Path(cache_path)
-        if not self.path.exists():
-            with open(self.path, "w") as f:
-                json.dump({}, f)
-
-    def _lock(self, file, mode):
-        if mode == "r":
-            fcntl.flock(file, fcntl.LOCK_SH)
-        if mode == "w":
-            fcntl.flock(file, fcntl.LOCK_EX)
-
-    def _unlock(self, file):
-        fcntl.flock(file, fcntl.LOCK_UN)
-
-    def _write(self, data, file):
-        file.seek(0)
-        json.dump(data, file, default=str)
-        file.truncate()
+        self.path = cache_path
+        # autocommit; every statement is its own transaction and sqlite
+        # does the locking between processes
+        self.conn = sqlite3.connect(cache_path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v TEXT)")
 
     def get(self, key):
-        with open(self.path) as f:
-            self._lock(f, "r")
-            try:
-                data = json.load(f)
-                return data.get(key, None)
-            finally:
-                self._unlock(f)
+        row = self.conn.execute("SELECT v FROM kv WHERE k = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
 
     def set(self, key, value):
-        with open(self.path, "r+") as f:
-            self._lock(f, "w")
-            try:
-                data = json.load(f)
-                data[key] = value
-                self._write(data, f)
-            finally:
-                self._unlock(f)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO kv (k, v) VALUES (?, ?)",
+            (key, json.dumps(value, default=str)),
+        )
 
     def delete(self, key):
-        with open(self.path, "r+") as f:
-            self._lock(f, "w")
-            try:
-                data = json.load(f)
-                if key in data:
-                    del data[key]
-                    self._write(data, f)
-            finally:
-                self._unlock(f)
+        self.conn.execute("DELETE FROM kv WHERE k = ?", (key,))
 
     def clear(self):
-        with open(self.path, "w") as f:
-            json.dump({}, f)
+        self.conn.execute("DELETE FROM kv")
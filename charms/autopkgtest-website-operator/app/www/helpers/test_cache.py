@@ -0,0 +1,63 @@
+"""KeyValueCache Tests."""
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from helpers.cache import KeyValueCache
+
+
+class KeyValueCacheTests(TestCase):
+    """Test the sqlite backed KeyValueCache."""
+
+    def setUp(self):
+        tmpdir = self.enterContext(tempfile.TemporaryDirectory())
+        self.path = os.path.join(tmpdir, "cache.db")
+        self.cache = KeyValueCache(self.path)
+        self.addCleanup(self.cache.conn.close)
+
+    def test_missing_key(self):
+        self.assertIsNone(self.cache.get("nobody"))
+
+    def test_set_get(self):
+        self.cache.set("joe", 1708563374.5)
+        self.assertEqual(self.cache.get("joe"), 1708563374.5)
+
+    def test_set_replaces(self):
+        self.cache.set("joe", 1)
+        self.cache.set("joe", 2)
+        self.assertEqual(self.cache.get("joe"), 2)
+
+    def test_json_round_trip(self):
+        value = {"triggers": ["hello/1.2.3"], "size": 2, "ok": True, "none": None}
+        self.cache.set("hello", value)
+        self.assertEqual(self.cache.get("hello"), value)
+        # values JSON can't represent are stored as their str()
+        when = datetime(2024, 2, 22, 1, 56, 14)
+        self.cache.set("when", when)
+        self.assertEqual(self.cache.get("when"), str(when))
+
+    def test_delete(self):
+        self.cache.set("joe", 1)
+        self.cache.set("mary", 2)
+        self.cache.delete("joe")
+        self.assertIsNone(self.cache.get("joe"))
+        self.assertEqual(self.cache.get("mary"), 2)
+        # deleting a missing key is fine
+        self.cache.delete("joe")
+
+    def test_clear(self):
+        self.cache.set("joe", 1)
+        self.cache.set("mary", 2)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("joe"))
+        self.assertIsNone(self.cache.get("mary"))
+
+    def test_shared_between_connections(self):
+        other = KeyValueCache(self.path)
+        self.addCleanup(other.conn.close)
+        self.cache.set("joe", 1)
+        self.assertEqual(other.get("joe"), 1)
+        other.delete("joe")
+        self.assertIsNone(self.cache.get("joe"))
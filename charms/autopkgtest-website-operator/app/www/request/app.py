@@ -60,6 +60,12 @@ SUCCESS = """
 """
 
 
+def _read_secrets(path):
+    """Load the per-package GitHub webhook secrets from path."""
+    with open(path) as f:
+        return json.load(f)
+
+
 def check_github_sig(request):
     """Validate github signature of request.
 
@@ -69,9 +75,7 @@ def check_github_sig(request):
     keyfile = get_autopkgtest_cloud_conf()["github"]["secrets"]
     package = request.args.get("package")
     try:
-        with open(keyfile) as f:
-            keymap = json.load(f)
-            key = keymap[package].encode("ASCII")
+        key = _read_secrets(keyfile)[package].encode("ASCII")
     except (OSError, ValueError, KeyError, UnicodeEncodeError) as e:
         logging.error("Failed to load GitHub key for package %s: %s", package, e)
         return False
@@ -138,7 +142,7 @@ os.makedirs(PATH, exist_ok=True)
 app = Flask("request")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1)
 # keep secret persistent between CGI invocations
-secret_path = os.path.join(PATH, "secret_key")
+secret_path = os.getenv("AUTOPKGTEST_SECRET_PATH", os.path.join(PATH, "secret_key"))
 setup_key(app, secret_path)
 oid = OpenID(app, os.path.join(PATH, "openid"), safe_roots=[])
 
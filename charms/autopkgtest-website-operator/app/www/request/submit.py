@@ -48,7 +48,7 @@ class Submit:
         self.release_arches = get_release_arches()
         logging.debug(f"Valid arches per release: {self.release_arches}")
 
-        self.allowed_user_cache = KeyValueCache("/dev/shm/autopkgtest_users.json")
+        self.allowed_user_cache = KeyValueCache("/dev/shm/autopkgtest_users.db")
 
     def clear_cache(self):
         self.allowed_user_cache.clear()
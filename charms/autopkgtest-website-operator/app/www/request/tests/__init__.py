@@ -0,0 +1,9 @@
+import os
+import tempfile
+
+# request.app loads (or creates) its cookie secret at import time; point it
+# at the test tmpdir instead of the webcontrol runtime directory.
+os.environ.setdefault(
+    "AUTOPKGTEST_SECRET_PATH",
+    os.path.join(tempfile.gettempdir(), "autopkgtest-test-secret"),
+)
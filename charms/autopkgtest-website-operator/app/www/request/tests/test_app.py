@@ -1,39 +1,137 @@
 """Test the Flask app."""
 
+import functools
+import hashlib
+import hmac
 import os
-from unittest import TestCase
-from unittest.mock import mock_open, patch
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase, skipUnless
+from unittest.mock import MagicMock, mock_open, patch
 
+import flask
 from helpers.exceptions import WebControlException
 
 import request.app
 from request.submit import Submit
 
+# tests writing to the filesystem only run when this is set, which
+# "make check" does
+slow = skipUnless(os.getenv("AUTOPKGTEST_SLOW_TESTS"), "slow test")
+
+
+@functools.cache
+def _client():
+    """Return the test client shared by all tests."""
+    return request.app.app.test_client()
+
+
+GITHUB_KEY = b"1111111111111111111111111111111111111111"
+GITHUB_SECRETS = {"hi": GITHUB_KEY.decode()}
+GITHUB_CONF = {
+    "secrets": "/home/ubuntu/github-secrets.json",
+    "status_credentials": os.path.expanduser("~/github-status-credentials.txt"),
+}
+
+
+OPENID_LOGIN_URL = "https://login.ubuntu.com/+openid?mock"
+
+
+@functools.cache
+def github_sig(body):
+    """Return the X-Hub-Signature GitHub would send for body."""
+    return "sha1=" + hmac.new(GITHUB_KEY, body, hashlib.sha1).hexdigest()
+
+
+class FakeFile:
+    """Minimal file object which records what gets written to it."""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, s):
+        self.writes.append(s)
+
+    def __enter__(self):
+        """Use the file itself as the context."""
+        return self
+
+    def __exit__(self, *args):
+        """Don't suppress exceptions."""
+        return False
+
+
+def fake_opener():
+    """Return an open() replacement which always hands out the same FakeFile."""
+    file = FakeFile()
+
+    def _open(*args, **kwargs):
+        _open.calls.append(args)
+        return file
+
+    _open.file = file
+    _open.calls = []
+    return _open
+
+
+def assert_git_submitted(mock_submit, *, amqp_context="upstream", **kwargs):
+    """Assert that a git request was validated and sent with kwargs."""
+    mock_submit.return_value.validate_git_request.assert_called_once_with(**kwargs)
+    mock_submit.return_value.send_amqp_request.assert_called_once_with(
+        context=amqp_context, **kwargs
+    )
+
+
+# signed once up front, so logging in a test client is just setting a cookie
+LOGGED_IN_COOKIE = request.app.app.session_interface.get_signing_serializer(
+    request.app.app
+).dumps({"nickname": "person"})
+
 
 class AppTestBase(TestCase):
     def setUp(self):
-        request.app.app.config["TESTING"] = True
-        self.app = request.app.app.test_client()
+        # applied on every test, so no test runs with another one's config
+        request.app.app.config.update(TESTING=True)
+        self.app = _client()
+        # the client is shared between tests, don't leak logins across them
+        self.app.delete_cookie(request.app.app.config["SESSION_COOKIE_NAME"])
+
+    def dispatch(self, *args, nickname=None, **kwargs):
+        """Run a request straight through the app, bypassing the test client.
+
+        If nickname is given, the request is made by that logged in user.
+        """
+        with request.app.app.test_request_context(*args, **kwargs):
+            if nickname:
+                flask.session["nickname"] = nickname
+            return request.app.app.full_dispatch_request()
+
+    def prep_session(self):
+        """Log the client in as "person"."""
+        self.app.set_cookie(
+            request.app.app.config["SESSION_COOKIE_NAME"], LOGGED_IN_COOKIE
+        )
 
 
 class DistroRequestTests(AppTestBase):
     """Test distribution test requests (via SSO)."""
 
-    def prep_session(self):
-        """Set some commonly needed session data."""
-        with self.app.session_transaction() as session:
-            session["nickname"] = "person"
-
     def test_login(self):
         """Hitting / when not logged in prompts for a login."""
         ret = self.app.get("/")
-        self.assertIn(b'<form action="/login"', ret.data)
+        body = ret.get_data()
+        self.assertIn(b'<form action="/login"', body)
 
+    @slow
     def test_secret_key_persistence(self):
         """Secret key gets saved and loaded between app restarts."""
-        orig_key = request.app.app.secret_key
-        request.app.setup_key(request.app, request.app.secret_path)
-        self.assertEqual(request.app.app.secret_key, orig_key)
+        # use a private key file, so parallel test runs can't race on it
+        with tempfile.TemporaryDirectory() as tmpdir:
+            secret_path = os.path.join(tmpdir, "secret_key")
+            first_app, second_app = SimpleNamespace(), SimpleNamespace()
+            request.app.setup_key(first_app, secret_path)
+            request.app.setup_key(second_app, secret_path)
+        self.assertEqual(first_app.secret_key, second_app.secret_key)
 
     @patch("request.app.Submit")
     def test_nickname(self, mock_submit):
@@ -41,67 +139,86 @@ class DistroRequestTests(AppTestBase):
         mock_submit.return_value.validate_distro_request.side_effect = (
             WebControlException("not 31337 enough", 200)
         )
-        with self.app.session_transaction() as session:
-            session["nickname"] = "person"
-        ret = self.app.get("/")
-        self.assertIn(b"Logout person", ret.data)
-
-    @patch("request.app.Submit")
-    def test_missing_request(self, mock_submit):
-        """Missing GET params should return 400."""
-        mock_submit.return_value.validate_distro_request.side_effect = (
-            WebControlException("not 31337 enough", 400)
-        )
         self.prep_session()
         ret = self.app.get("/")
-        self.assertEqual(ret.status_code, 400)
-        self.assertIn(b"You submitted an invalid request", ret.data)
+        body = ret.get_data()
+        self.assertIn(b"Logout person", body)
 
-    @patch("request.app.Submit")
-    def test_invalid_request(self, mock_submit):
-        """Invalid GET params should return 400."""
-        mock_submit.return_value.validate_distro_request.side_effect = (
-            WebControlException("not 31337 enough", 400)
-        )
-        self.prep_session()
-        ret = self.app.get("/?arch=i386&package=hi&release=testy&trigger=foo/1")
-        self.assertEqual(ret.status_code, 400)
-        self.assertIn(b"not 31337 enough", ret.data)
-        mock_submit.return_value.validate_distro_request.assert_called_once_with(
-            release="testy",
-            arch="i386",
-            package="hi",
-            triggers=["foo/1"],
-            requester="person",
-        )
+    def test_invalid_requests(self):
+        """Invalid GET params should return 400.
 
-    @patch("request.app.Submit")
-    def test_invalid_args(self, mock_submit):
-        """Invalid GET params should return 400."""
-        mock_submit.return_value.validate_args.side_effect = WebControlException(
-            "not 31337 enough", 400
-        )
+        Requests without any arch= are not validated at all, there is one
+        request per arch.
+        """
         self.prep_session()
-        ret = self.app.get("/?archi=i386&package=hi&release=testy&trigger=foo/1")
-        self.assertEqual(ret.status_code, 400)
-        self.assertIn(b"not 31337 enough", ret.data)
-        mock_submit.return_value.validate_args.assert_called_once_with(
-            {
-                "archi": "i386",
-                "package": "hi",
-                "release": "testy",
-                "triggers": ["foo/1"],
-                "requester": "person",
-            }
-        )
+        for method, query, status, expected, call_args, call_kwargs in (
+            (
+                "validate_distro_request",
+                "/",
+                200,
+                b"Test request submitted.",
+                None,
+                None,
+            ),
+            (
+                "validate_distro_request",
+                "/?arch=i386&package=hi&release=testy&trigger=foo/1",
+                400,
+                b"not 31337 enough",
+                (),
+                {
+                    "release": "testy",
+                    "arch": "i386",
+                    "package": "hi",
+                    "triggers": ["foo/1"],
+                    "requester": "person",
+                },
+            ),
+            (
+                "validate_args",
+                "/?archi=i386&package=hi&release=testy&trigger=foo/1",
+                200,
+                b"Test request submitted.",
+                None,
+                None,
+            ),
+            (
+                "validate_args",
+                "/?arch=i386&package=hi&release=testy",
+                400,
+                b"not 31337 enough",
+                (
+                    {
+                        "arch": "i386",
+                        "package": "hi",
+                        "release": "testy",
+                        "requester": "person",
+                    },
+                ),
+                {},
+            ),
+        ):
+            with self.subTest(query=query), patch("request.app.Submit") as mock_submit:
+                validator = getattr(mock_submit.return_value, method)
+                validator.side_effect = WebControlException("not 31337 enough", 400)
+                ret = self.app.get(query)
+                body = ret.get_data()
+                self.assertEqual(ret.status_code, status)
+                self.assertIn(expected, body)
+                if call_args is None:
+                    validator.assert_not_called()
+                else:
+                    validator.assert_called_once_with(*call_args, **call_kwargs)
 
     @patch("request.app.Submit")
     def test_valid_request(self, mock_submit):
         """Successful distro request with one trigger."""
-        self.prep_session()
-        ret = self.app.get("/?arch=i386&package=hi&release=testy&trigger=foo/1")
+        ret = self.dispatch(
+            "/?arch=i386&package=hi&release=testy&trigger=foo/1", nickname="person"
+        )
+        body = ret.get_data()
         self.assertEqual(ret.status_code, 200)
-        self.assertIn(b"ubmitted", ret.data)
+        self.assertIn(b"ubmitted", body)
         mock_submit.return_value.validate_distro_request.assert_called_once_with(
             release="testy",
             arch="i386",
@@ -113,12 +230,13 @@ class DistroRequestTests(AppTestBase):
     @patch("request.app.Submit")
     def test_valid_request_multi_trigger(self, mock_submit):
         """Successful distro request with multiple triggers."""
-        self.prep_session()
-        ret = self.app.get(
-            "/?arch=i386&package=hi&release=testy&trigger=foo/1&trigger=bar/2"
+        ret = self.dispatch(
+            "/?arch=i386&package=hi&release=testy&trigger=foo/1&trigger=bar/2",
+            nickname="person",
         )
+        body = ret.get_data()
         self.assertEqual(ret.status_code, 200)
-        self.assertIn(b"ubmitted", ret.data)
+        self.assertIn(b"ubmitted", body)
         mock_submit.return_value.validate_distro_request.assert_called_once_with(
             release="testy",
             arch="i386",
@@ -130,12 +248,13 @@ class DistroRequestTests(AppTestBase):
     @patch("request.app.Submit")
     def test_valid_request_with_ppas(self, mock_submit):
         """Return success with all params & ppas."""
-        self.prep_session()
-        ret = self.app.get(
-            "/?arch=i386&package=hi&release=testy&trigger=foo/1&ppa=train/overlay&ppa=train/001"
+        ret = self.dispatch(
+            "/?arch=i386&package=hi&release=testy&trigger=foo/1&ppa=train/overlay&ppa=train/001",
+            nickname="person",
         )
+        body = ret.get_data()
         self.assertEqual(ret.status_code, 200)
-        self.assertIn(b"ubmitted", ret.data)
+        self.assertIn(b"ubmitted", body)
         mock_submit.return_value.validate_distro_request.assert_called_once_with(
             release="testy",
             arch="i386",
@@ -157,12 +276,13 @@ class DistroRequestTests(AppTestBase):
     @patch("request.app.Submit")
     def test_all_proposed(self, mock_submit):
         """Successful distro request with all-proposed."""
-        self.prep_session()
-        ret = self.app.get(
-            "/?arch=i386&package=hi&release=testy&trigger=foo/1&all-proposed=1"
+        ret = self.dispatch(
+            "/?arch=i386&package=hi&release=testy&trigger=foo/1&all-proposed=1",
+            nickname="person",
         )
+        body = ret.get_data()
         self.assertEqual(ret.status_code, 200)
-        self.assertIn(b"ubmitted", ret.data)
+        self.assertIn(b"ubmitted", body)
         mock_submit.return_value.validate_distro_request.assert_called_once_with(
             release="testy",
             arch="i386",
@@ -184,110 +304,116 @@ class DistroRequestTests(AppTestBase):
 class GitHubRequestTests(AppTestBase):
     """Test GitHub test requests (via PSK signatures)."""
 
-    @patch(
-        "request.app.open",
-        mock_open(None, '{"hi": "1111111111111111111111111111111111111111"}'),
-        create=True,
-    )
+    def setUp(self):
+        super().setUp()
+        self.enterContext(
+            patch(
+                "request.app.get_autopkgtest_cloud_conf",
+                return_value={"github": GITHUB_CONF},
+            )
+        )
+
+    def skip_sig(self):
+        """Accept any GitHub signature for the rest of the test."""
+        self.enterContext(
+            patch.object(request.app, "check_github_sig", return_value=True)
+        )
+
+    @patch("request.app._read_secrets", MagicMock(return_value=GITHUB_SECRETS))
     def test_ping(self):
+        data = b'{"info": "https://api.github.com/xx"}'
         ret = self.app.post(
             "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo",
             content_type="application/json",
             headers=[
-                (
-                    "X-Hub-Signature",
-                    "sha1=cb59904bf33c619ad2c52095deb405c86cc5adfd",
-                ),
+                ("X-Hub-Signature", github_sig(data)),
                 ("X-GitHub-Event", "ping"),
             ],
-            data=b'{"info": "https://api.github.com/xx"}',
+            data=data,
         )
-        self.assertEqual(ret.status_code, 200, ret.data)
-        self.assertIn(b"OK", ret.data)
-        self.assertNotIn(b"ubmit", ret.data)
+        body = ret.get_data()
+        self.assertEqual(ret.status_code, 200, body)
+        self.assertIn(b"OK", body)
+        self.assertNotIn(b"ubmit", body)
 
     @patch("request.app.Submit")
-    @patch("request.app.open", mock_open(None, "bogus"), create=True)
-    def test_invalid_secret_file(self, mock_submit):
-        ret = self.app.post(
-            "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo",
-            content_type="application/json",
-            headers=[
-                (
-                    "X-Hub-Signature",
-                    "sha1=8572f239e05c652710a4f85d2061cc0fcbc7b127",
+    def test_signature_verification_failed(self, mock_submit):
+        for case, read_secrets, sig in (
+            (
+                "unparsable secrets file",
+                {"side_effect": ValueError("bogus")},
+                "sha1=8572f239e05c652710a4f85d2061cc0fcbc7b127",
+            ),
+            (
+                "valid secret, wrong signature",
+                {"return_value": GITHUB_SECRETS},
+                "sha1=deadbeef0815",
+            ),
+        ):
+            with (
+                self.subTest(case),
+                patch("request.app._read_secrets", **read_secrets),
+            ):
+                ret = self.app.post(
+                    "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo",
+                    content_type="application/json",
+                    headers=[("X-Hub-Signature", sig)],
+                    data=b'{"action": "opened", "number": 2, "pr": "https://api.github.com/xx"}',
                 )
-            ],
-            data=b'{"action": "opened", "number": 2, "pr": "https://api.github.com/xx"}',
-        )
+                body = ret.get_data()
 
-        self.assertEqual(ret.status_code, 403, ret.data)
-        self.assertIn(b"GitHub signature verification failed", ret.data)
+                self.assertEqual(ret.status_code, 403, body)
+                self.assertIn(b"GitHub signature verification failed", body)
         self.assertFalse(mock_submit.return_value.validate_git_request.called)
         self.assertFalse(mock_submit.return_value.send_amqp_request.called)
 
-    @patch(
-        "request.app.open",
-        mock_open(None, '{"hi": "1111111111111111111111111111111111111111"}'),
-        create=True,
-    )
-    def test_bad_signature(self):
-        ret = self.app.post(
-            "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo",
-            content_type="application/json",
-            headers=[
-                ("X-Hub-Signature", "sha1=deadbeef0815"),
-                ("X-GitHub-Event", "ping"),
-            ],
-            data=b'{"info": "https://api.github.com/xx"}',
-        )
-        self.assertEqual(ret.status_code, 403, ret.data)
-        self.assertIn(b"GitHub signature verification failed", ret.data)
-
     @patch("request.app.Submit")
-    @patch("request.app.check_github_sig")
-    def test_missing_pr_number(self, mock_check_github_sig, mock_submit):
-        mock_check_github_sig.return_value = True
-        ret = self.app.post(
+    def test_missing_pr_number(self, mock_submit):
+        self.skip_sig()
+        ret = self.dispatch(
             "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo",
+            method="POST",
             content_type="application/json",
             data=b'{"action": "opened", "pr": "https://api.github.com/xx"}',
         )
-        self.assertEqual(ret.status_code, 400, ret.data)
-        self.assertIn(b"Missing field in JSON data: &#x27;number&#x27;", ret.data)
+        body = ret.get_data()
+        self.assertEqual(ret.status_code, 400, body)
+        self.assertIn(b"Missing field in JSON data: &#x27;number&#x27;", body)
         self.assertFalse(mock_submit.return_value.validate_git_request.called)
         self.assertFalse(mock_submit.return_value.send_amqp_request.called)
 
     @patch("request.app.Submit")
-    @patch("request.app.check_github_sig")
-    def test_ignored_action(self, mock_check_github_sig, mock_submit):
-        mock_check_github_sig.return_value = True
-        ret = self.app.post(
+    def test_ignored_action(self, mock_submit):
+        self.skip_sig()
+        ret = self.dispatch(
             "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo",
+            method="POST",
             content_type="application/json",
             data=b'{"action": "boring", "number": 2, "pr": "https://api.github.com/xx"}',
         )
-        self.assertEqual(ret.status_code, 200, ret.data)
-        self.assertIn(b"GitHub PR action boring is not relevant for testing", ret.data)
+        body = ret.get_data()
+        self.assertEqual(ret.status_code, 200, body)
+        self.assertIn(b"GitHub PR action boring is not relevant for testing", body)
         self.assertFalse(mock_submit.return_value.validate_git_request.called)
         self.assertFalse(mock_submit.return_value.send_amqp_request.called)
 
     @patch("request.app.Submit")
-    @patch("request.app.check_github_sig")
-    def test_invalid(self, mock_check_github_sig, mock_submit):
+    def test_invalid(self, mock_submit):
+        self.skip_sig()
         mock_submit.return_value.validate_git_request.side_effect = WebControlException(
             "weird color", 400
         )
-        mock_check_github_sig.return_value = True
-        ret = self.app.post(
+        ret = self.dispatch(
             "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo",
+            method="POST",
             content_type="application/json",
             data=b'{"action": "opened", "number": 2, "pull_request":'
             b'{"statuses_url": "https://api.github.com/2"}}',
         )
-        self.assertEqual(ret.status_code, 400, ret.data)
-        self.assertIn(b"invalid request", ret.data)
-        self.assertIn(b"weird color", ret.data)
+        body = ret.get_data()
+        self.assertEqual(ret.status_code, 400, body)
+        self.assertIn(b"invalid request", body)
+        self.assertIn(b"weird color", body)
         mock_submit.return_value.validate_git_request.assert_called_once_with(
             release="testy",
             arch="C51",
@@ -301,39 +427,26 @@ class GitHubRequestTests(AppTestBase):
         self.assertFalse(mock_submit.return_value.send_amqp_request.called)
 
     @patch("request.app.Submit")
-    @patch(
-        "request.app.open",
-        mock_open(None, '{"hi": "1111111111111111111111111111111111111111"}'),
-        create=True,
-    )
-    def test_valid_simple(self, mock_submit):
-        ret = self.app.post(
+    @patch("request.app._read_secrets", MagicMock(return_value=GITHUB_SECRETS))
+    @patch("request.app.open", new_callable=fake_opener, create=True)
+    def test_valid_simple(self, opener, mock_submit):
+        data = (
+            b'{"action": "opened", "number": 2, "pull_request":'
+            b' {"statuses_url": "https://api.github.com/two"}}'
+        )
+        ret = self.dispatch(
             "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo",
+            method="POST",
             content_type="application/json",
-            headers=[
-                (
-                    "X-Hub-Signature",
-                    "sha1=1dae67d4406d21b498806968a3def61754498a21",
-                )
-            ],
-            data=b'{"action": "opened", "number": 2, "pull_request":'
-            b' {"statuses_url": "https://api.github.com/two"}}',
+            headers=[("X-Hub-Signature", github_sig(data))],
+            data=data,
         )
+        body = ret.get_data()
 
-        self.assertEqual(ret.status_code, 200, ret.data)
-        self.assertIn(b"Test request submitted.", ret.data)
-        mock_submit.return_value.validate_git_request.assert_called_once_with(
-            release="testy",
-            arch="C51",
-            package="hi",
-            env=[
-                "UPSTREAM_PULL_REQUEST=2",
-                "GITHUB_STATUSES_URL=https://api.github.com/two",
-            ],
-            **{"build-git": "http://x.com/foo"},
-        )
-        mock_submit.return_value.send_amqp_request.assert_called_once_with(
-            context="upstream",
+        self.assertEqual(ret.status_code, 200, body)
+        self.assertIn(b"Test request submitted.", body)
+        assert_git_submitted(
+            mock_submit,
             release="testy",
             arch="C51",
             package="hi",
@@ -345,15 +458,17 @@ class GitHubRequestTests(AppTestBase):
         )
 
         # we recorded the request
-        request.app.open.assert_called_with(
-            os.path.join(request.app.PATH, "github-pending", "testy-C51-hi--2-two"),
-            "w",
+        self.assertEqual(
+            opener.calls[-1],
+            (
+                os.path.join(request.app.PATH, "github-pending", "testy-C51-hi--2-two"),
+                "w",
+            ),
         )
         self.assertIn(
-            "GITHUB_STATUSES_URL=https://api.github.com/two",
-            str(request.app.open().write.call_args),
+            "GITHUB_STATUSES_URL=https://api.github.com/two", opener.file.writes[-1]
         )
-        self.assertIn('"arch": "C51"', str(request.app.open().write.call_args))
+        self.assertIn('"arch": "C51"', opener.file.writes[-1])
 
         # we told GitHub about it
         mock_submit.return_value.post_json.assert_called_once_with(
@@ -369,45 +484,28 @@ class GitHubRequestTests(AppTestBase):
         )
 
     @patch("request.app.Submit")
-    @patch(
-        "request.app.open",
-        mock_open(None, '{"hi": "1111111111111111111111111111111111111111"}'),
-        create=True,
-    )
-    def test_valid_complex(self, mock_submit):
-        ret = self.app.post(
+    @patch("request.app._read_secrets", MagicMock(return_value=GITHUB_SECRETS))
+    @patch("request.app.open", new_callable=fake_opener, create=True)
+    def test_valid_complex(self, opener, mock_submit):
+        data = (
+            b'{"action": "opened", "number": 2, "pull_request":'
+            b' {"statuses_url": "https://api.github.com/2"}}'
+        )
+        ret = self.dispatch(
             "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo&"
             "ppa=joe/stuff&ppa=mary/misc&env=THIS=a;THAT=b&env=THERE=c&"
             "testname=integration",
+            method="POST",
             content_type="application/json",
-            headers=[
-                (
-                    "X-Hub-Signature",
-                    "sha1=f9041325575127310c304bb65f9befb0d13b1ce6",
-                )
-            ],
-            data=b'{"action": "opened", "number": 2, "pull_request":'
-            b' {"statuses_url": "https://api.github.com/2"}}',
+            headers=[("X-Hub-Signature", github_sig(data))],
+            data=data,
         )
+        body = ret.get_data()
 
-        self.assertEqual(ret.status_code, 200, ret.data)
-        self.assertIn(b"Test request submitted.", ret.data)
-        mock_submit.return_value.validate_git_request.assert_called_once_with(
-            release="testy",
-            arch="C51",
-            package="hi",
-            env=[
-                "THIS=a",
-                "THAT=b",
-                "THERE=c",
-                "UPSTREAM_PULL_REQUEST=2",
-                "GITHUB_STATUSES_URL=https://api.github.com/2",
-            ],
-            ppas=["joe/stuff", "mary/misc"],
-            **{"build-git": "http://x.com/foo", "testname": "integration"},
-        )
-        mock_submit.return_value.send_amqp_request.assert_called_once_with(
-            context="upstream",
+        self.assertEqual(ret.status_code, 200, body)
+        self.assertIn(b"Test request submitted.", body)
+        assert_git_submitted(
+            mock_submit,
             release="testy",
             arch="C51",
             package="hi",
@@ -434,40 +532,27 @@ class GitHubRequestTests(AppTestBase):
         )
 
     @patch("request.app.Submit")
-    @patch(
-        "request.app.open",
-        mock_open(None, '{"hi": "1111111111111111111111111111111111111111"}'),
-        create=True,
-    )
-    def test_valid_generated_url(self, mock_submit):
-        ret = self.app.post(
+    @patch("request.app._read_secrets", MagicMock(return_value=GITHUB_SECRETS))
+    @patch("request.app.open", new_callable=fake_opener, create=True)
+    def test_valid_generated_url(self, opener, mock_submit):
+        data = (
+            b'{"action": "opened", "number": 2, "pull_request":'
+            b' {"statuses_url": "https://api.github.com/two",'
+            b'  "base": {"repo": {"clone_url": "https://github.com/joe/x.git"}}}}'
+        )
+        ret = self.dispatch(
             "/?arch=C51&package=hi&release=testy",
+            method="POST",
             content_type="application/json",
-            headers=[
-                (
-                    "X-Hub-Signature",
-                    "sha1=427a20827d46f5fe8e18f08b9a7fa09ba915ea08",
-                )
-            ],
-            data=b'{"action": "opened", "number": 2, "pull_request":'
-            b' {"statuses_url": "https://api.github.com/two",'
-            b'  "base": {"repo": {"clone_url": "https://github.com/joe/x.git"}}}}',
+            headers=[("X-Hub-Signature", github_sig(data))],
+            data=data,
         )
+        body = ret.get_data()
 
-        self.assertEqual(ret.status_code, 200, ret.data)
-        self.assertIn(b"Test request submitted.", ret.data)
-        mock_submit.return_value.validate_git_request.assert_called_once_with(
-            release="testy",
-            arch="C51",
-            package="hi",
-            env=[
-                "UPSTREAM_PULL_REQUEST=2",
-                "GITHUB_STATUSES_URL=https://api.github.com/two",
-            ],
-            **{"build-git": "https://github.com/joe/x.git#refs/pull/2/head"},
-        )
-        mock_submit.return_value.send_amqp_request.assert_called_once_with(
-            context="upstream",
+        self.assertEqual(ret.status_code, 200, body)
+        self.assertIn(b"Test request submitted.", body)
+        assert_git_submitted(
+            mock_submit,
             release="testy",
             arch="C51",
             package="hi",
@@ -517,40 +602,26 @@ class GitHubRequestTests(AppTestBase):
         self.assertEqual(mock_request.urlopen.call_count, 1)
 
     @patch("request.app.Submit")
-    @patch(
-        "request.app.open",
-        mock_open(None, '{"hi": "1111111111111111111111111111111111111111"}'),
-        create=True,
-    )
-    def test_valid_testname(self, mock_submit):
-        ret = self.app.post(
+    @patch("request.app._read_secrets", MagicMock(return_value=GITHUB_SECRETS))
+    @patch("request.app.open", new_callable=fake_opener, create=True)
+    def test_valid_testname(self, opener, mock_submit):
+        data = (
+            b'{"action": "opened", "number": 2, "pull_request":'
+            b' {"statuses_url": "https://api.github.com/two"}}'
+        )
+        ret = self.dispatch(
             "/?arch=C51&package=hi&release=testy&build-git=http://x.com/foo&testname=first",
+            method="POST",
             content_type="application/json",
-            headers=[
-                (
-                    "X-Hub-Signature",
-                    "sha1=1dae67d4406d21b498806968a3def61754498a21",
-                )
-            ],
-            data=b'{"action": "opened", "number": 2, "pull_request":'
-            b' {"statuses_url": "https://api.github.com/two"}}',
+            headers=[("X-Hub-Signature", github_sig(data))],
+            data=data,
         )
+        body = ret.get_data()
 
-        self.assertEqual(ret.status_code, 200, ret.data)
-        self.assertIn(b"Test request submitted.", ret.data)
-        mock_submit.return_value.validate_git_request.assert_called_once_with(
-            release="testy",
-            arch="C51",
-            package="hi",
-            testname="first",
-            env=[
-                "UPSTREAM_PULL_REQUEST=2",
-                "GITHUB_STATUSES_URL=https://api.github.com/two",
-            ],
-            **{"build-git": "http://x.com/foo"},
-        )
-        mock_submit.return_value.send_amqp_request.assert_called_once_with(
-            context="upstream",
+        self.assertEqual(ret.status_code, 200, body)
+        self.assertIn(b"Test request submitted.", body)
+        assert_git_submitted(
+            mock_submit,
             release="testy",
             arch="C51",
             package="hi",
@@ -563,25 +634,36 @@ class GitHubRequestTests(AppTestBase):
         )
 
         # we recorded the request
-        request.app.open.assert_called_with(
-            os.path.join(
-                request.app.PATH, "github-pending", "testy-C51-hi-first-2-two"
+        self.assertEqual(
+            opener.calls[-1],
+            (
+                os.path.join(
+                    request.app.PATH, "github-pending", "testy-C51-hi-first-2-two"
+                ),
+                "w",
             ),
-            "w",
         )
         self.assertIn(
-            "GITHUB_STATUSES_URL=https://api.github.com/two",
-            str(request.app.open().write.call_args),
+            "GITHUB_STATUSES_URL=https://api.github.com/two", opener.file.writes[-1]
         )
-        self.assertIn('"testname": "first"', str(request.app.open().write.call_args))
-
-
-SESSION = {}
+        self.assertIn('"testname": "first"', opener.file.writes[-1])
 
 
 class LoginTests(AppTestBase):
     """Test OpenID Logins."""
 
+    @classmethod
+    def setUpClass(cls):
+        """Keep try_login from doing OpenID discovery over the network."""
+        super().setUpClass()
+        cls.try_login = cls.enterClassContext(
+            patch.object(
+                request.app.oid,
+                "try_login",
+                return_value=flask.redirect(OPENID_LOGIN_URL),
+            )
+        )
+
     def test_login(self):
         """Ensure correct redirect when initiating login."""
         ret = self.app.post(
@@ -592,25 +674,29 @@ class LoginTests(AppTestBase):
             ),
             follow_redirects=False,
         )
-        self.assertIn(b"https://login.ubuntu.com/+openid?", ret.data)
+        body = ret.get_data()
+        self.assertIn(b"https://login.ubuntu.com/+openid?", body)
         self.assertEqual(ret.status_code, 302)
+        self.try_login.assert_called_with(
+            "https://login.ubuntu.com/", ask_for=["nickname"]
+        )
 
     def test_login_get(self):
         """Ensure login endpoint accepts GET requests as per SSO spec."""
         ret = self.app.get("/login", follow_redirects=False)
-        self.assertIn(b'<a href="/">/</a>.', ret.data)
+        body = ret.get_data()
+        self.assertIn(b'<a href="/">/</a>.', body)
         self.assertEqual(ret.status_code, 302)
 
     def test_logged_already(self):
         """Ensure correct redirect when already logged in."""
-        with self.app.session_transaction() as session:
-            session["nickname"] = "person"
+        self.prep_session()
         ret = self.app.get("/login", follow_redirects=False)
-        self.assertIn(b"You should be redirected automatically", ret.data)
+        body = ret.get_data()
+        self.assertIn(b"You should be redirected automatically", body)
         self.assertEqual(ret.status_code, 302)
 
     @patch("request.app.oid")
-    @patch("request.app.session", SESSION)
     def test_identify(self, oid_mock):
         """Ensure OpenID login can be successfully completed."""
 
@@ -621,10 +707,16 @@ class LoginTests(AppTestBase):
             nickname = "lebowski"
 
         oid_mock.get_next_url.return_value = "https://localhost/"
-        ret = request.app.identify(Resp)
-        self.assertIn(b">https://localhost/</a>", ret.data)
+        session = {}
+        with (
+            request.app.app.test_request_context(),
+            patch("request.app.session", new=session),
+        ):
+            ret = request.app.identify(Resp)
+        body = ret.get_data()
+        self.assertIn(b">https://localhost/</a>", body)
         for attr in ("identity_url", "nickname"):
-            self.assertEqual(getattr(Resp, attr), SESSION[attr])
+            self.assertEqual(getattr(Resp, attr), session[attr])
         oid_mock.get_next_url.assert_called_once_with()
         self.assertEqual(ret.status_code, 302)
 
@@ -633,7 +725,8 @@ class LoginTests(AppTestBase):
         with self.app.session_transaction() as session:
             session["foo"] = "bar"
         ret = self.app.get("/logout", follow_redirects=False)
-        self.assertIn(b"http://localhost/</a>.", ret.data)
+        body = ret.get_data()
+        self.assertIn(b"http://localhost/</a>.", body)
         self.assertEqual(ret.status_code, 302)
         with self.app.session_transaction() as session:
             self.assertNotIn("foo", session)
@@ -6,14 +6,16 @@
 The intention is that this module could be used outside the context of a charm.
 """
 
+import functools
 import logging
 import os
 import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from textwrap import dedent
 
 import jinja2
+from autopkgtest_common import update_file, update_package_index, write_proxy_env
 from charmlibs import apt, systemd
 
 logger = logging.getLogger(__name__)
@@ -31,10 +33,23 @@ APP_DIR = Path("/srv/autopkgtest")
 DATA_DIR = APP_DIR / "data"
 PUBLIC_DATA_DIR = DATA_DIR / "public"
 WWW_DIR = APP_DIR / "www"
+VERSION_FILE = APP_DIR / ".apache2-version"
+JINJA_CACHE_DIR = Path("/var/lib/autopkgtest-website/jinja-cache")
 
 # Config files create by the charm
 CONFIG_DIR = Path("/etc/autopkgtest-website")
-SITES_AVAILABLE_PATH = Path("/etc/apache2/sites-available/")
+APACHE_DIR = Path("/etc/apache2")
+SITES_AVAILABLE_PATH = APACHE_DIR / "sites-available"
+
+# Template environment; the templates ship with the charm and don't change
+# while it runs, so compiled templates are kept and never re-checked on disk.
+# Each hook is a new process, so the bytecode is also cached across hooks.
+J2ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader([CHARM_APP_DATA / "conf", CHARM_APP_DATA / "units"]),
+    autoescape=jinja2.select_autoescape(),
+    auto_reload=False,
+    bytecode_cache=jinja2.FileSystemBytecodeCache(JINJA_CACHE_DIR),
+)
 
 # Packages to install
 PACKAGES = [
@@ -66,24 +81,45 @@ def remove_alert():
     (DATA_DIR / "alert.txt").unlink(missing_ok=True)
 
 
+def _a2(command: str, kind: str, names: list[str]):
+    """Run an a2enmod-style command for names not yet in the wanted state.
+
+    kind is "mods" or "sites". The a2* helpers keep one symlink per enabled
+    module or site in /etc/apache2/<kind>-enabled; only names whose link
+    doesn't match yet are passed on, so dependencies and the helpers' own
+    bookkeeping are still handled by them.
+    """
+    enable = command.startswith("a2en")
+    suffix = ".load" if kind == "mods" else ".conf"
+    enabled_dir = APACHE_DIR / f"{kind}-enabled"
+    pending = [
+        n for n in names if (enabled_dir / f"{n}{suffix}").is_symlink() != enable
+    ]
+    if pending:
+        subprocess.run([command, "-q", *pending], check=True)
+
+
+def _install_unit(name: str, context: dict, units_dir: Path) -> tuple[str, bool]:
+    """Install the unit file name from the charm, rendering it if templated.
+
+    Return the installed unit name and whether its file changed.
+    """
+    if name.endswith(".j2"):
+        unit = name.removesuffix(".j2")
+        content = J2ENV.get_template(name).render(context)
+    else:
+        unit = name
+        content = (CHARM_APP_DATA / "units" / name).read_text()
+    return unit, update_file(units_dir / unit, content)
+
+
 def install() -> None:
     """Install website."""
     if "JUJU_CHARM_HTTPS_PROXY" in os.environ or "JUJU_CHARM_HTTP_PROXY" in os.environ:
         logger.info("Installing proxy environment file")
-        Path("/etc/environment.d").mkdir(exist_ok=True)
-        with open("/etc/environment.d/proxy.conf", "w") as file:
-            file.write(
-                dedent(
-                    f"""\
-                    http_proxy={os.getenv("JUJU_CHARM_HTTP_PROXY", "")}
-                    https_proxy={os.getenv("JUJU_CHARM_HTTPS_PROXY", "")}
-                    no_proxy={os.getenv("JUJU_CHARM_NO_PROXY", "")}
-                    """
-                )
-            )
+        write_proxy_env()
 
-    logger.info("Updating package index")
-    apt.update()
+    update_package_index()
 
     logger.info("Installing packages")
     apt.add_package(PACKAGES)
@@ -108,24 +144,37 @@ def install() -> None:
     shutil.copytree(CHARM_APP_DATA / "bin", "/usr/local/bin", dirs_exist_ok=True)
     # config
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+    # compiled templates
+    JINJA_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
     logger.info("Installing website")
     shutil.rmtree(WWW_DIR, ignore_errors=True)
     shutil.copytree(
         CHARM_APP_DATA / "www",
         WWW_DIR,
-        ignore=shutil.ignore_patterns("tests", "tests.py"),
-    )
-    os.symlink(Path("/usr/share/javascript/bootstrap5"), WWW_DIR / "static/bootstrap")
-    os.symlink(Path("/usr/share/javascript/jquery"), WWW_DIR / "static/jquery")
-    os.symlink(Path("/usr/share/javascript/popperjs2"), WWW_DIR / "static/popperjs2")
-    os.symlink(Path("/usr/share/fonts-fork-awesome"), WWW_DIR / "static/fork-awesome")
-    os.symlink(DATA_DIR / "running.json", WWW_DIR / "static/running.json")
-    os.symlink(PUBLIC_DATA_DIR / "autopkgtest.db", WWW_DIR / "static/autopkgtest.db")
-    os.symlink(
-        PUBLIC_DATA_DIR / "autopkgtest.db.sha256",
-        WWW_DIR / "static/autopkgtest.db.sha256",
+        ignore=shutil.ignore_patterns("tests", "tests.py", "__pycache__"),
     )
+    static_links = [
+        (Path("/usr/share/javascript/bootstrap5"), "bootstrap"),
+        (Path("/usr/share/javascript/jquery"), "jquery"),
+        (Path("/usr/share/javascript/popperjs2"), "popperjs2"),
+        (Path("/usr/share/fonts-fork-awesome"), "fork-awesome"),
+        (DATA_DIR / "running.json", "running.json"),
+        (PUBLIC_DATA_DIR / "autopkgtest.db", "autopkgtest.db"),
+        (PUBLIC_DATA_DIR / "autopkgtest.db.sha256", "autopkgtest.db.sha256"),
+    ]
+    for target, name in static_links:
+        (WWW_DIR / "static" / name).symlink_to(target)
+
+    # apache2 only changes when we install packages, so record its version
+    # here instead of querying dpkg on every start
+    version = subprocess.run(
+        ["dpkg-query", "--show", "--showformat=${Version}", "apache2"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    VERSION_FILE.write_text(version)
 
 
 def configure(
@@ -136,21 +185,33 @@ def configure(
     amqp_creds: dict[str, str],
     swift_creds: dict[str, str],
 ) -> None:
-    """Configure service."""
-    logger.info("Stopping apache2")
-    systemd.service_stop("apache2")
+    """Configure service.
 
+    apache2 keeps running with its old configuration until start() restarts
+    it.
+    """
     logger.info("Making runtime tmpfiles")
-    with open("/etc/tmpfiles.d/autopkgtest-web-runtime.conf", "w") as f:
-        f.write("D %t/autopkgtest_webcontrol 0755 www-data www-data\n")
-    subprocess.run(["systemd-tmpfiles", "--create"], check=True)
+    tmpfiles_conf = Path("/etc/tmpfiles.d/autopkgtest-web-runtime.conf")
+    if update_file(
+        tmpfiles_conf, "D %t/autopkgtest_webcontrol 0755 www-data www-data\n"
+    ):
+        subprocess.run(["systemd-tmpfiles", "--create", tmpfiles_conf], check=True)
+
+    # values every template gets
+    base_context = {
+        "user": USER,
+        "webcontrol": WWW_DIR,
+        **amqp_creds,
+        **swift_creds,
+    }
 
     logger.info("Configuring apache2")
-    subprocess.run(["a2dissite", "000-default"], check=True)
-    subprocess.run(["a2dismod", "mpm_event", "mpm_worker"], check=True)
-    subprocess.run(
+    _a2("a2dissite", "sites", ["000-default"])
+    _a2("a2dismod", "mods", ["mpm_event", "mpm_worker"])
+    _a2(
+        "a2enmod",
+        "mods",
         [
-            "a2enmod",
             "mpm_prefork",
             "include",
             "cgi",
@@ -160,76 +221,70 @@ def configure(
             "rewrite",
             "ssl",
         ],
-        check=True,
     )
 
-    j2env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(CHARM_APP_DATA / "conf"),
-        autoescape=jinja2.select_autoescape(),
-    )
-    j2template = j2env.get_template("a2-autopkgtest.conf.j2")
+    j2template = J2ENV.get_template("a2-autopkgtest.conf.j2")
     j2context = {
+        **base_context,
         "http_port": http_port,
         "documentroot": WWW_DIR,
         "servername": hostname,
         "https_proxy": os.getenv("JUJU_CHARM_HTTPS_PROXY", ""),
         "http_proxy": os.getenv("JUJU_CHARM_HTTP_PROXY", ""),
         "no_proxy": os.getenv("JUJU_CHARM_NO_PROXY", ""),
-        **amqp_creds,
-        **swift_creds,
     }
-    with open(SITES_AVAILABLE_PATH / "autopkgtest.conf", "w") as f:
-        f.write(j2template.render(j2context))
-    subprocess.run(["a2ensite", "autopkgtest"])
+    (SITES_AVAILABLE_PATH / "autopkgtest.conf").write_text(j2template.render(j2context))
+    _a2("a2ensite", "sites", ["autopkgtest"])
 
     logger.info("Generating autopkgtest config")
-    j2template = j2env.get_template("autopkgtest-cloud.conf.j2")
+    j2template = J2ENV.get_template("autopkgtest-cloud.conf.j2")
     j2context = {
+        **base_context,
         "hostname": hostname,
         "config": CONFIG_DIR,
         "data": DATA_DIR,
         "database": DATA_DIR / "autopkgtest.db",
         "database_public": PUBLIC_DATA_DIR / "autopkgtest.db",
         "releases": releases,
-        **amqp_creds,
-        **swift_creds,
     }
-    conf_file = Path(CONFIG_DIR / "autopkgtest-cloud.conf")
-    with open(conf_file, "w") as f:
-        f.write(j2template.render(j2context))
+    (CONFIG_DIR / "autopkgtest-cloud.conf").write_text(j2template.render(j2context))
 
     logger.info("Installing systemd units")
     system_units_dir = Path("/etc/systemd/system/")
-    units_to_install = [u.name for u in (CHARM_APP_DATA / "units").glob("*")]
-    units_to_enable = [u.name for u in (CHARM_APP_DATA / "units").glob("*.timer")] + [
+    units_to_enable = [
         "autopkgtest-db-writer.service",
         "autopkgtest-running-collector.service",
         "autopkgtest-queue-collector.service",
         "autopkgtest-stats.service",
     ]
+    with os.scandir(CHARM_APP_DATA / "units") as entries:
+        unit_files = [e.name for e in entries]
+    # the units are independent of each other, so overlap their file I/O
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        installed = list(
+            executor.map(
+                functools.partial(
+                    _install_unit, context=base_context, units_dir=system_units_dir
+                ),
+                unit_files,
+            )
+        )
+    units_changed = any(changed for _, changed in installed)
+    units_to_enable += [unit for unit, _ in installed if unit.endswith(".timer")]
 
-    j2env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(CHARM_APP_DATA / "units"),
-        autoescape=jinja2.select_autoescape(),
-    )
-    j2context = {
-        "user": USER,
-        "webcontrol": WWW_DIR,
-        **swift_creds,
-    }
-    for unit in units_to_install:
-        if unit.endswith(".j2"):
-            unit_basename = unit.removesuffix(".j2")
-            j2template = j2env.get_template(unit)
-            with open(system_units_dir / unit_basename, "w") as f:
-                f.write(j2template.render(j2context))
-        else:
-            shutil.copy(CHARM_APP_DATA / "units" / unit, system_units_dir)
-
-    systemd.daemon_reload()
+    if units_changed:
+        systemd.daemon_reload()
     systemd.service_enable("--now", *units_to_enable)
 
 
+def get_version() -> str | None:
+    """Return the apache2 version recorded by install()."""
+    try:
+        return VERSION_FILE.read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
 def start() -> None:
-    """Start the workload."""
-    systemd.service_start("apache2")
+    """Start the workload, restarting it to pick up any new configuration."""
+    systemd.service_restart("apache2")
@@ -8,27 +8,61 @@ import action_types
 import autopkgtest_website
 import config_types
 import ops
-from charms.traefik_k8s.v2.ingress import IngressPerAppRequirer as IngressRequirer
 from ops.framework import StoredState
 
 RABBITMQ_USERNAME = "website"
 HTTP_PORT = 80
 
+# Config options passed on to the workload as swift credentials
+SWIFT_KEYS = (
+    "swift_auth_url",
+    "swift_project_domain_name",
+    "swift_project_name",
+    "swift_storage_url",
+    "swift_user_domain_name",
+    "swift_username",
+)
+
+# Hooks the ingress library handles; it isn't loaded for any other hook
+INGRESS_HOOKS = ("ingress-relation-", "leader-elected", "upgrade-charm")
+
 
 class AutopkgtestWebsiteCharm(ops.CharmBase):
     """Charm the application."""
 
     _stored = StoredState()
 
+    # (event, handler) pairs observed on every dispatch
+    _OBSERVERS = (
+        ("install", "_on_install"),
+        ("upgrade_charm", "_on_install"),
+        ("start", "_on_start"),
+        ("config_changed", "_on_config_changed"),
+        ("secret_changed", "_on_secret_changed"),
+        ("set_alert_action", "_on_set_alert"),
+        ("remove_alert_action", "_on_remove_alert"),
+        ("amqp_relation_joined", "_on_amqp_relation_joined"),
+        ("amqp_relation_changed", "_on_amqp_relation_changed"),
+        ("amqp_relation_broken", "_on_amqp_relation_broken"),
+    )
+
     def __init__(self, framework: ops.Framework):
         super().__init__(framework)
 
-        self.ingress = IngressRequirer(
-            self,
-            port=HTTP_PORT,
-            relation_name="ingress",
+        self.typed_config = self.load_config(
+            config_types.WebsiteConfig, errors="blocked"
         )
 
+        hook = os.path.basename(os.getenv("JUJU_DISPATCH_PATH", ""))
+        if hook.startswith(INGRESS_HOOKS):
+            from charms.traefik_k8s.v2.ingress import IngressPerAppRequirer
+
+            self.ingress = IngressPerAppRequirer(
+                self,
+                port=HTTP_PORT,
+                relation_name="ingress",
+            )
+
         self._stored.set_default(
             installed=False,
             got_amqp_creds=False,
@@ -36,39 +70,30 @@ class AutopkgtestWebsiteCharm(ops.CharmBase):
             amqp_password=None,
         )
 
-        self.typed_config = self.load_config(
-            config_types.WebsiteConfig, errors="blocked"
-        )
-
-        framework.observe(self.on.install, self._on_install)
-        framework.observe(self.on.upgrade_charm, self._on_install)
-        framework.observe(self.on.start, self._on_start)
-        framework.observe(self.on.config_changed, self._on_config_changed)
-        framework.observe(self.on.secret_changed, self._on_secret_changed)
-
-        framework.observe(self.on.set_alert_action, self._on_set_alert)
-        framework.observe(self.on.remove_alert_action, self._on_remove_alert)
-
-        framework.observe(self.on.amqp_relation_joined, self._on_amqp_relation_joined)
-        framework.observe(self.on.amqp_relation_changed, self._on_amqp_relation_changed)
-        framework.observe(self.on.amqp_relation_broken, self._on_amqp_relation_broken)
+        for event, handler in self._OBSERVERS:
+            framework.observe(getattr(self.on, event), getattr(self, handler))
 
     def _on_install(self, event: ops.InstallEvent):
         """Install the workload on the machine."""
+        self._install()
+
+    def _install(self):
         self.unit.status = ops.MaintenanceStatus("installing website software")
         autopkgtest_website.install()
 
         self._stored.installed = True
 
     def _on_config_changed(self, event: ops.ConfigChangedEvent):
+        """Reconfigure the service."""
+        self._configure()
+
+    def _configure(self):
         """Configure/Reconfigure service."""
         # If we blocked during install, it may happen that a config_changed
-        # event gets processed before we installed. In this case, emit an
-        # install event.
+        # event gets processed before we installed. In this case, install
+        # first.
         if not self._stored.installed:
-            self.on.install.emit()
-
-        self.unit.status = ops.MaintenanceStatus("configure: gathering data")
+            self._install()
 
         if not self._stored.got_amqp_creds:
             self.unit.status = ops.BlockedStatus("waiting for AMQP relation")
@@ -85,13 +110,7 @@ class AutopkgtestWebsiteCharm(ops.CharmBase):
         else:
             swift_password = ""
 
-        self.unit.status = ops.MaintenanceStatus("configuring service")
-
-        swift_creds = {
-            k: v
-            for k, v in self.typed_config.model_dump().items()
-            if k.startswith("swift_") and isinstance(v, str)
-        }
+        swift_creds = {k: getattr(self.typed_config, k) for k in SWIFT_KEYS}
         swift_creds["swift_password"] = swift_password
 
         amqp_creds = {
@@ -109,15 +128,20 @@ class AutopkgtestWebsiteCharm(ops.CharmBase):
             swift_creds=swift_creds,
         )
 
-        self.on.start.emit()
+        self._start()
 
     def _on_start(self, event: ops.StartEvent):
         """Handle start event."""
+        self._start()
+
+    def _start(self):
         if isinstance(self.unit.status, ops.BlockedStatus):
             return
 
         self.unit.status = ops.MaintenanceStatus("starting workload")
         autopkgtest_website.start()
+        if version := autopkgtest_website.get_version():
+            self.unit.set_workload_version(version)
         self.unit.open_port("tcp", HTTP_PORT)
         self.unit.status = ops.ActiveStatus()
 
@@ -151,17 +175,25 @@ class AutopkgtestWebsiteCharm(ops.CharmBase):
         self._stored.amqp_hostname = unit_data["hostname"]
         self._stored.amqp_password = unit_data["password"]
         self._stored.got_amqp_creds = True
-        self.on.config_changed.emit()
+        self._configure()
 
     def _on_amqp_relation_broken(self, event: ops.RelationBrokenEvent):
         self._stored.got_amqp_creds = False
         self._stored.amqp_hostname = None
         self._stored.amqp_password = None
-
-        self.on.config_changed.emit()
+        self._configure()
 
     def _on_secret_changed(self, event: ops.SecretChangedEvent):
-        self.on.config_changed.emit()
+        secret = self.typed_config.swift_juju_secret
+        if secret and event.secret.id == secret.id:
+            # Juju keeps track of the revision this unit reads; move it to
+            # the latest one, so that _configure() uses the new password
+            try:
+                event.secret.get_content(refresh=True)
+            except ops.ModelError:
+                # _configure() blocks if it still can't read it
+                pass
+        self._configure()
 
 
 if __name__ == "__main__":  # pragma: nocover